@@ -1,19 +1,27 @@
-from dataclasses import dataclass
+import functools
+import gc
+import inspect
+import weakref
+from collections import defaultdict
+from dataclasses import dataclass, fields
 from types import ModuleType
 from typing import (
     Any,
     Callable,
+    DefaultDict,
     Dict,
     Iterator,
     List,
     Optional,
     Sequence,
+    Tuple,
     Type,
     Union,
     cast,
 )
 
 import tree_sitter
+from dataclasses_json import DataClassJsonMixin
 
 from tree_sitter_type_provider.node_types import Branch as Branch
 from tree_sitter_type_provider.node_types import Leaf as Leaf
@@ -24,6 +32,47 @@ from tree_sitter_type_provider.node_types import NodeType as NodeType
 from tree_sitter_type_provider.node_types import NodeTypeError as NodeTypeError
 from tree_sitter_type_provider.node_types import NodeTypeName as NodeTypeName
 from tree_sitter_type_provider.node_types import Point as Point
+from tree_sitter_type_provider.node_types import _LazyText, _SourceText
+from tree_sitter_type_provider.node_types import to_dict as to_dict
+from tree_sitter_type_provider.node_types import to_json as to_json
+
+# Maximum number of points kept by TreeSitterTypeProvider._point_cache.
+_POINT_CACHE_SIZE = 4096
+
+# Functions to get the node type name of objects of exactly these classes.
+_NODE_TYPE_NAME_BY_CLASS: Dict[type, Callable[[Any], str]] = {
+    tree_sitter.Node: lambda node: cast(str, node.type),
+    NodeType: lambda node: cast(str, node.type_name),
+    str: lambda node: cast(str, node),
+}
+
+# Number of parents kept by TreeSitterTypeProvider._parent_cache.
+_PARENT_CACHE_SIZE = 32
+
+# A recently found parent: weak references to the node, its parent, and the
+# root under which the parent was found.
+_ParentCacheEntry = Tuple["weakref.ref[Node]", "weakref.ref[Node]", "weakref.ref[Node]"]
+
+# Names of the fields shared by all nodes.
+_NODE_FIELD_NAMES = frozenset(field.name for field in fields(Node))
+
+# Minimum size in bytes of branches whose text is decoded lazily.
+_LAZY_TEXT_SIZE = 1024
+
+# A partially converted node: its fields, children, node type, node class,
+# whether or not it has children, field name in its parent, start and end
+# positions, and text.
+_Frame = Tuple[
+    Dict[str, Union[None, Node, List[Node]]],
+    List[Node],
+    NodeType,
+    Type[Node],
+    bool,
+    Optional[str],
+    Point,
+    Point,
+    Union[str, _SourceText],
+]
 
 
 @dataclass
@@ -42,8 +91,48 @@ class ParseError(Exception, Branch):
         else:
             return f" between {self._point_to_str(self.start_position)} and {self._point_to_str(self.end_position)}"
 
+    def _lines(self, contents: str) -> List[str]:
+        # NOTE: Only the lines between the start and end position are split,
+        #       so the cost does not depend on the size of the contents.
+        start = 0
+        for _ in range(self.start_position.line):
+            start = contents.find("\n", start) + 1
+            if start == 0:
+                return []
+        if start >= len(contents):
+            return []
+        end = start
+        for _ in range(self.end_position.line - self.start_position.line + 1):
+            end = contents.find("\n", end) + 1
+            if end == 0:
+                end = len(contents)
+                break
+        # NOTE: Lines are split on "\n" only, like tree-sitter counts rows.
+        region = contents[start:end]
+        if region.endswith("\n"):
+            region = region[:-1]
+        return [
+            line[:-1] if line.endswith("\r") else line for line in region.split("\n")
+        ]
+
+    @staticmethod
+    def _annotation(line: str, start: int, end: int) -> str:
+        # NOTE: The annotation is exactly as long as the line.
+        start = min(start, len(line))
+        carets = max(0, min(end + 1, len(line)) - start)
+        return " " * start + "^" * carets + " " * (len(line) - start - carets)
+
     def _annotated_region(self) -> str:
         if self.contents:
+            lines = self._lines(self.contents)
+
+            # Errors usually span a single line.
+            if len(lines) == 1:
+                line = lines[0]
+                annotation = self._annotation(
+                    line, self.start_position.column, self.end_position.column
+                )
+                return f"{line}\n{annotation}"
 
             def _annotated_lines(
                 lines: Sequence[str],
@@ -54,16 +143,8 @@ class ParseError(Exception, Branch):
                     is_last_line = l == len(lines) - 1
                     start = self.start_position.column if is_first_line else 0
                     end = self.end_position.column if is_last_line else len(line)
-                    annotation: List[str] = []
-                    for c, _ in enumerate(line):
-                        if c < start or end < c:
-                            annotation.append(" ")
-                        else:
-                            annotation.append("^")
-                    yield "".join(annotation)
+                    yield self._annotation(line, start, end)
 
-            lines = self.contents.splitlines()
-            lines = lines[self.start_position.line : self.end_position.line + 1]
             return "\n".join(_annotated_lines(lines))
         else:
             return self.text
@@ -79,11 +160,29 @@ class ParseError(Exception, Branch):
         )
 
 
+def _child_nodes(node: Node) -> Iterator[Node]:
+    for field in fields(node):
+        # NOTE: Skip the fields of Node, which do not contain nodes, so that
+        #       lazily decoded text is not decoded.
+        if field.name in _NODE_FIELD_NAMES:
+            continue
+        value = getattr(node, field.name)
+        if isinstance(value, Node):
+            yield value
+        elif isinstance(value, list):
+            for child in value:
+                if isinstance(child, Node):
+                    yield child
+
+
 class TreeSitterTypeProvider(ModuleType):
     def _node_type_name(
         self,
         node: Union[NodeTypeName, Node, NodeType, tree_sitter.Node],
     ) -> str:
+        get_node_type_name = _NODE_TYPE_NAME_BY_CLASS.get(type(node), None)
+        if get_node_type_name is not None:
+            return get_node_type_name(node)
         if isinstance(node, tree_sitter.Node):
             return cast(str, node.type)
         elif isinstance(node, Node):
@@ -124,7 +223,9 @@ class TreeSitterTypeProvider(ModuleType):
         return cls
 
     def _node_hash(self, tsnode: tree_sitter.Node) -> int:
-        return hash((tsnode.start_byte, tsnode.end_byte))
+        # NOTE: The id is unique within a tree, but may be reused for an
+        #       unchanged node in a tree that is reparsed after an edit.
+        return tsnode.id
 
     def from_tree_sitter(
         self,
@@ -133,105 +234,173 @@ class TreeSitterTypeProvider(ModuleType):
         encoding: str = "utf-8",
         filename: Optional[str] = None,
         raise_parse_error: bool = False,
+        disable_gc: bool = False,
     ) -> Node:
         if isinstance(tsvalue, tree_sitter.Tree):
             tsvalue = tsvalue.root_node
         if isinstance(tsvalue, tree_sitter.Node):
             tsvalue = tsvalue.walk()
-        return self._from_tree_cursor(
-            tsvalue,
-            encoding=encoding,
-            filename=filename,
-            raise_parse_error=raise_parse_error,
-        )
+        if not disable_gc:
+            return self._walk(
+                tsvalue,
+                encoding=encoding,
+                filename=filename,
+                raise_parse_error=raise_parse_error,
+            )
+        # NOTE: Conversion allocates many nodes and lists, none of which form
+        #       reference cycles, so running the cyclic garbage collector
+        #       while converting only repeatedly traverses the new nodes.
+        #       However, the collector is process-wide, so it is only paused
+        #       on request, and is re-enabled if it was enabled before.
+        gc_was_enabled = gc.isenabled()
+        gc.disable()
+        try:
+            return self._walk(
+                tsvalue,
+                encoding=encoding,
+                filename=filename,
+                raise_parse_error=raise_parse_error,
+            )
+        finally:
+            if gc_was_enabled:
+                gc.enable()
 
-    def _from_tree_cursor(
+    def _walk(
         self,
         tscursor: tree_sitter.TreeCursor,
         *,
-        encoding: str = "utf-8",
-        filename: Optional[str] = None,
+        encoding: str,
+        filename: Optional[str],
         raise_parse_error: bool,
     ) -> Node:
-        if tscursor.node.is_named:
-            # Convert basic information.
-            text: str = tscursor.node.text.decode(encoding)
-            type_name: str = tscursor.node.type
-            node_type: NodeType = self._node_type(type_name)
-            start_position: Point = Point.from_tree_sitter(tscursor.node.start_point)
-            end_position: Point = Point.from_tree_sitter(tscursor.node.end_point)
-
-            # Convert children.
-            fields: Dict[str, Union[None, Node, List[Node]]] = {}
-            children: List[Node] = []
-
-            def convert_child(tscursor: tree_sitter.TreeCursor) -> None:
+        if not tscursor.node.is_named:
+            raise TypeError(tscursor.node.type)
+
+        # NOTE: The whole tree is traversed with this one cursor, which is
+        #       returned to the node where the walk started. No other cursor
+        #       is created, and tree_sitter.Node.children is never used.
+        tsnode_start = tscursor.node
+
+        # NOTE: The tree is converted in post-order using an explicit stack
+        #       of partially converted nodes, one for each named ancestor of
+        #       the node under the cursor, rather than by recursion.
+        stack: List[_Frame] = []
+
+        # NOTE: Points are immutable, so nodes which start or end at the same
+        #       position can share the same Point instance.
+        point_cache = self._point_cache
+
+        def to_point(tspoint: Tuple[int, int]) -> Point:
+            point = point_cache.get(tspoint)
+            if point is None:
+                if len(point_cache) >= _POINT_CACHE_SIZE:
+                    point_cache.clear()
+                point = point_cache[tspoint] = Point.from_tree_sitter(tspoint)
+            return point
+
+        dispatch = self._dispatch
+        tsnode = tsnode_start
+
+        # NOTE: The text of large branches is only decoded from the source
+        #       when it is first accessed, since it is often never used, and
+        #       decoding it for every branch copies the source once for every
+        #       level of the tree.
+        source: bytes = tsnode.text
+        source_offset: int = tsnode.start_byte
+        field_name: Optional[str] = None
+        descend = True
+        while True:
+            if descend:
+                # Convert basic information.
                 try:
-                    field_name = tscursor.field_name
-                except AttributeError:
-                    field_name = tscursor.current_field_name()
-                child = self._from_tree_cursor(
-                    tscursor,
-                    encoding=encoding,
-                    filename=filename,
-                    raise_parse_error=raise_parse_error,
-                )
-                if field_name is None:
-                    children.append(child)
+                    cls, node_type, has_children, lazy_text = dispatch[tsnode.type]
+                except KeyError:
+                    raise NodeTypeError(
+                        f"Could not find node type {tsnode.type}"
+                    ) from None
+                start_byte = tsnode.start_byte - source_offset
+                end_byte = tsnode.end_byte - source_offset
+                text: Union[str, _SourceText]
+                if lazy_text and end_byte - start_byte > _LAZY_TEXT_SIZE:
+                    text = _SourceText(source, start_byte, end_byte, encoding)
                 else:
-                    if node_type.fields[field_name].multiple:
-                        if field_name in fields:
-                            field_value = fields[field_name]
-                            if field_value is None:
-                                fields[field_name] = child
-                            elif isinstance(field_value, Node):
-                                fields[field_name] = [field_value, child]
-                            else:
-                                field_value.append(child)
-                        else:
-                            fields[field_name] = [child]
-                    else:
-                        fields[field_name] = child
-
-            if tscursor.goto_first_child():
-                if tscursor.node.is_named:
-                    convert_child(tscursor)
-                while tscursor.goto_next_sibling():
-                    if tscursor.node.is_named:
-                        convert_child(tscursor)
-                assert tscursor.goto_parent()
-
-            # Handle optional fields.
-            for field_name, field_type in node_type.fields.items():
-                if not field_type.required and field_name not in fields:
-                    if field_type.multiple:
-                        fields[field_name] = []
-                    else:
-                        fields[field_name] = None
+                    text = source[start_byte:end_byte].decode(encoding)
+                start_position = to_point(tsnode.start_point)
+                end_position = to_point(tsnode.end_point)
+
+                # Start with the defaults for optional fields.
+                fields: Dict[str, Union[None, Node, List[Node]]]
+                fields = dict.fromkeys(node_type._defaults_none_keys)
+                for node_field_name in node_type._defaults_list_keys:
+                    fields[node_field_name] = []
+
+                stack.append(
+                    (
+                        fields,
+                        [],
+                        node_type,
+                        cls,
+                        has_children,
+                        field_name,
+                        start_position,
+                        end_position,
+                        text,
+                    )
+                )
+                moved = tscursor.goto_first_child()
+            else:
+                moved = tscursor.goto_next_sibling()
+
+            # Enter named nodes, skip over anonymous nodes.
+            if moved:
+                tsnode = tscursor.node
+                descend = tsnode.is_named
+                if descend:
+                    field_name = tscursor.field_name
+                continue
+            if not descend:
+                # NOTE: The move must not be inside the assert, since asserts
+                #       are stripped when running with -O.
+                moved = tscursor.goto_parent()
+                assert moved
+
+            # Convert the node under the cursor.
+            (
+                fields,
+                children,
+                node_type,
+                cls,
+                has_children,
+                field_name,
+                start_position,
+                end_position,
+                text,
+            ) = stack.pop()
+            type_name = node_type.type_name
 
             # Create node instance
-            kwargs: Dict[str, Union[str, Point, None, Node, List[Node]]] = {}
+            kwargs: Dict[
+                str, Union[str, _SourceText, Point, None, Node, List[Node]]
+            ] = {}
             kwargs["type_name"] = type_name
             kwargs["text"] = text
             kwargs["start_position"] = start_position
             kwargs["end_position"] = end_position
-            if self._node_has_children(tscursor.node):
+            if has_children:
                 kwargs["children"] = children
             kwargs.update(fields)
 
-            # Return the node with its field name.
             if raise_parse_error and type_name == "ERROR":
-
-                def _root_node(tsnode: tree_sitter.Node) -> str:
-                    # TODO: node->tree isn't bound in tree_sitter_talon
-                    if tsnode.parent:
-                        return _root_node(tsnode.parent)
-                    else:
-                        return cast(str, tsnode.text.decode("utf-8"))
-
-                contents = _root_node(tscursor.node)
-                raise ParseError(
-                    text=text,
+                # TODO: node->tree isn't bound in tree_sitter_talon
+                # NOTE: The root is found with a loop rather than recursion,
+                #       so that deeply nested errors do not exceed the
+                #       recursion limit.
+                tsroot = tscursor.node
+                while tsroot.parent is not None:
+                    tsroot = tsroot.parent
+                contents = cast(str, tsroot.text.decode("utf-8"))
+                raise self._parse_error_class(
+                    text=text if isinstance(text, str) else text.decode(),
                     type_name=type_name,
                     start_position=start_position,
                     end_position=end_position,
@@ -239,10 +408,65 @@ class TreeSitterTypeProvider(ModuleType):
                     contents=contents,
                     filename=filename,
                 )
+            node = cls(**kwargs)  # type: ignore[arg-type]
+            if isinstance(text, _SourceText):
+                _LazyText.defer(node, text)
+
+            # Return the root node, or add the node to its parent.
+            if not stack:
+                assert tscursor.node == tsnode_start
+                return node
+            parent_fields, parent_children, parent_node_type = stack[-1][:3]
+            if field_name is None:
+                parent_children.append(node)
             else:
-                return self._node_class(tscursor.node)(**kwargs)  # type: ignore[arg-type]
-        else:
-            raise TypeError(tscursor.node.type)
+                if field_name in parent_node_type._multiple_fields:
+                    if field_name in parent_fields:
+                        field_value = parent_fields[field_name]
+                        if field_value is None:
+                            parent_fields[field_name] = node
+                        elif isinstance(field_value, Node):
+                            parent_fields[field_name] = [field_value, node]
+                        else:
+                            field_value.append(node)
+                    else:
+                        parent_fields[field_name] = [node]
+                else:
+                    parent_fields[field_name] = node
+            descend = False
+
+    def parent_of(self, node: Node, *, root: Node) -> Optional[Node]:
+        # Check the recently found parents.
+        # NOTE: The cache only holds weak references, so it does not keep
+        #       converted trees alive, and its entries are specific to a root.
+        for entry in self._parent_cache:
+            if entry is not None:
+                child_ref, parent_ref, root_ref = entry
+                if child_ref() is node and root_ref() is root:
+                    return parent_ref()
+
+        # Search for the parent, descending only into nodes whose range
+        # contains the range of the node.
+        start = (node.start_position.line, node.start_position.column)
+        end = (node.end_position.line, node.end_position.column)
+        candidates: List[Node] = [root]
+        while candidates:
+            candidate = candidates.pop()
+            for child in _child_nodes(candidate):
+                if child is node:
+                    self._parent_cache[self._parent_cache_head] = (
+                        weakref.ref(node),
+                        weakref.ref(candidate),
+                        weakref.ref(root),
+                    )
+                    self._parent_cache_head += 1
+                    self._parent_cache_head %= _PARENT_CACHE_SIZE
+                    return candidate
+                child_start = (child.start_position.line, child.start_position.column)
+                child_end = (child.end_position.line, child.end_position.column)
+                if child_start <= start and end <= child_end:
+                    candidates.append(child)
+        return None
 
     def __init__(
         self,
@@ -253,9 +477,31 @@ class TreeSitterTypeProvider(ModuleType):
         as_class_name: Optional[Callable[[str], str]] = None,
         mixins: Sequence[type] = (),
         dataclass_kwargs: Dict[str, Any] = {},
+        json: bool = False,
     ):
         super().__init__(name=module_name)
 
+        # Add to_dict, to_json, etc. to the node classes
+        if json and DataClassJsonMixin not in mixins:
+            mixins = (*mixins, DataClassJsonMixin)
+
+        # Class for ERROR nodes
+        self._parse_error_class: Type[ParseError] = ParseError
+        if DataClassJsonMixin in mixins:
+            self._parse_error_class = cast(
+                Type[ParseError],
+                type("ParseError", (ParseError, DataClassJsonMixin), {}),
+            )
+
+        # Cache of points, shared between conversions
+        self._point_cache: Dict[Tuple[int, int], Point] = {}
+
+        # Ring buffer of recently found parents, used by parent_of
+        self._parent_cache: List[Optional[_ParentCacheEntry]] = [
+            None
+        ] * _PARENT_CACHE_SIZE
+        self._parent_cache_head: int = 0
+
         if as_class_name is None:
 
             def snake_to_pascal(node_type_name: str) -> str:
@@ -263,6 +509,9 @@ class TreeSitterTypeProvider(ModuleType):
 
             as_class_name = snake_to_pascal
 
+        # NOTE: The class name for each node type is needed many times.
+        as_class_name = functools.lru_cache(maxsize=None)(as_class_name)
+
         # Dictionary of named node types
         self._node_types_by_type: Dict[str, NodeType] = {}
         for node_type in node_types:
@@ -295,7 +544,7 @@ class TreeSitterTypeProvider(ModuleType):
         self._extra: Sequence[NodeType] = tuple(_extra_node_types())
 
         # Dictionary of abstract classes
-        self._node_bases_by_type: Dict[str, List[Type[Node]]] = {}
+        node_bases_by_type: DefaultDict[str, List[Type[Node]]] = defaultdict(list)
         for node_type in self._node_types_by_type.values():
             if node_type.is_abstract:
                 abscls = node_type.as_type(
@@ -308,16 +557,17 @@ class TreeSitterTypeProvider(ModuleType):
                 setattr(self, abscls_name, abscls)
                 for subtype in node_type.subtypes:
                     if subtype.named:
-                        if subtype.type_name not in self._node_bases_by_type:
-                            self._node_bases_by_type[subtype.type_name] = []
-                        self._node_bases_by_type[subtype.type_name].append(abscls)
+                        node_bases_by_type[subtype.type_name].append(abscls)
+        self._node_bases_by_type: Dict[str, List[Type[Node]]] = dict(node_bases_by_type)
 
         # Dictionary of dataclasses
         self._node_classes_by_type: Dict[str, Type[Node]] = {}
         for node_type in self._node_types_by_type.values():
             if node_type.type_name == "ERROR":
-                self._node_classes_by_type["ERROR"] = ParseError
-                setattr(self, as_class_name(node_type.type_name), ParseError)
+                self._node_classes_by_type["ERROR"] = self._parse_error_class
+                setattr(
+                    self, as_class_name(node_type.type_name), self._parse_error_class
+                )
             else:
                 bases = self._node_bases_by_type.get(node_type.type_name, ())
                 cls = node_type.as_type(
@@ -328,3 +578,22 @@ class TreeSitterTypeProvider(ModuleType):
                 )
                 self._node_classes_by_type[node_type.type_name] = cls
                 setattr(self, as_class_name(node_type.type_name), cls)
+
+        # Dictionary of node classes, node types, whether or not the nodes
+        # have children, and whether or not their text can be decoded lazily,
+        # used when converting from tree-sitter.
+        # NOTE: Any node with content can have extra nodes,
+        #       even if the node only has fields and no children.
+        # NOTE: The text of a node can only be decoded lazily if its class
+        #       still uses _LazyText, which is not the case if, for instance,
+        #       the class was created with slots=True.
+        self._dispatch: Dict[str, Tuple[Type[Node], NodeType, bool, bool]] = {
+            type_name: (
+                cls,
+                node_type,
+                node_type.has_content,
+                isinstance(inspect.getattr_static(cls, "text", None), _LazyText),
+            )
+            for type_name, cls in self._node_classes_by_type.items()
+            for node_type in (self._node_types_by_type[type_name],)
+        }
@@ -1,17 +1,20 @@
-import functools
 import itertools
-from dataclasses import dataclass, field, make_dataclass
+import json
+from dataclasses import Field, dataclass, field, fields, is_dataclass, make_dataclass
 from typing import (
     Any,
     Callable,
     Dict,
+    FrozenSet,
     List,
+    NamedTuple,
     Optional,
     Sequence,
     Tuple,
     Type,
     Union,
     cast,
+    overload,
 )
 
 from dataclasses_json import DataClassJsonMixin, config, dataclass_json
@@ -21,7 +24,7 @@ class NodeTypeError(Exception):
     pass
 
 
-@dataclass
+@dataclass(frozen=True)
 class Point:
     line: int
     column: int
@@ -39,7 +42,7 @@ AsClassName = Callable[[NodeTypeName], str]
 
 
 @dataclass
-class Node(DataClassJsonMixin):
+class Node:
     text: str
     type_name: NodeTypeName = field(metadata=config(field_name="type"))
     start_position: Point
@@ -61,11 +64,112 @@ class Leaf(Node):
     pass
 
 
+class _SourceText(NamedTuple):
+    source: bytes
+    start_byte: int
+    end_byte: int
+    encoding: str
+
+    def decode(self) -> str:
+        return self.source[self.start_byte : self.end_byte].decode(self.encoding)
+
+
+class _LazyText:
+    """
+    The text of a branch whose text was deferred, which is decoded from the
+    source when it is first accessed. Branches whose text was not deferred
+    store it as an instance attribute, which takes precedence.
+    """
+
+    @overload
+    def __get__(self, node: None, owner: Optional[type] = None) -> "_LazyText": ...
+
+    @overload
+    def __get__(self, node: Node, owner: Optional[type] = None) -> str: ...
+
+    def __get__(
+        self, node: Optional[Node], owner: Optional[type] = None
+    ) -> Union["_LazyText", str]:
+        if node is None:
+            return self
+        source_text = cast(_SourceText, getattr(node, "_source_text"))
+        node.text = source_text.decode()
+        return node.text
+
+    @staticmethod
+    def defer(node: Node, source_text: _SourceText) -> None:
+        del node.text
+        setattr(node, "_source_text", source_text)
+
+
 @dataclass
 class Branch(Node):
     children: Union[None, Node, Sequence[Node]]
 
 
+# NOTE: This is set after the dataclass is created, so that the descriptor
+#       is not mistaken for the default value of a field.
+Branch.text = _LazyText()  # type: ignore[assignment]
+
+
+_ToDictFrame = Tuple[Any, Union[Dict[str, Any], List[Any]]]
+
+
+def to_dict(node: Node) -> Dict[str, Any]:
+    """
+    Convert a node to a dictionary, in the same format as the to_dict method
+    of nodes created with DataClassJsonMixin.
+    """
+    # NOTE: The node is converted with an explicit stack of values and the
+    #       containers they are converted into, rather than by recursion, so
+    #       that deeply nested trees do not exceed the recursion limit.
+    result: Dict[str, Any] = {}
+    stack: List[_ToDictFrame] = [(node, result)]
+    while stack:
+        value, container = stack.pop()
+        if isinstance(container, dict):
+            for field in fields(value):
+                container[_to_dict_field_name(field)] = _to_dict_item(
+                    getattr(value, field.name), stack
+                )
+        else:
+            for index, item in enumerate(value):
+                container[index] = _to_dict_item(item, stack)
+    return result
+
+
+def to_json(node: Node, **kwargs: Any) -> str:
+    """
+    Convert a node to JSON, in the same format as the to_json method of
+    nodes created with DataClassJsonMixin. Unlike to_dict, the depth of the
+    node is limited by the recursion limit of the json module.
+    """
+    return json.dumps(to_dict(node), **kwargs)
+
+
+def _to_dict_item(value: Any, stack: List[_ToDictFrame]) -> Any:
+    # NOTE: Dataclasses and lists are converted into empty containers, which
+    #       are filled in when they are popped from the stack.
+    container: Union[Dict[str, Any], List[Any]]
+    if is_dataclass(value) and not isinstance(value, type):
+        container = {}
+    elif isinstance(value, list):
+        container = [None] * len(value)
+    else:
+        return value
+    stack.append((value, container))
+    return container
+
+
+def _to_dict_field_name(field: "Field[Any]") -> str:
+    # NOTE: Respect field names overridden with dataclasses_json.config.
+    letter_case = field.metadata.get("dataclasses_json", {}).get("letter_case")
+    if letter_case is None:
+        return field.name
+    else:
+        return cast(str, letter_case(field.name))
+
+
 @dataclass
 class SimpleNodeType(DataClassJsonMixin):
     type_name: NodeTypeName = field(metadata=config(field_name="type"))
@@ -85,10 +189,11 @@ class SimpleNodeType(DataClassJsonMixin):
         *,
         as_class_name: AsClassName,
     ) -> Optional[Type[Node]]:
-        Ts: List[type] = []
-        for simple_node_type in simple_node_types:
-            if simple_node_type.named:
-                Ts.append(simple_node_type.as_typehint(as_class_name=as_class_name))
+        Ts: List[type] = [
+            simple_node_type.as_typehint(as_class_name=as_class_name)
+            for simple_node_type in simple_node_types
+            if simple_node_type.named
+        ]
 
         if len(Ts) == 0:
             return None
@@ -96,7 +201,7 @@ class SimpleNodeType(DataClassJsonMixin):
         if len(Ts) == 1:
             return Ts[0]
 
-        return functools.reduce(lambda R, T: cast(type, Union[R, T]), Ts)
+        return cast(type, Union[tuple(Ts)])
 
 
 @dataclass_json
@@ -171,6 +276,23 @@ class NodeType(SimpleNodeType):
         assert not (
             self.is_abstract and self.has_content
         ), "Nodes can have either fields and children or subtypes, but not both."
+        # Fields which can contain multiple nodes.
+        self._multiple_fields: FrozenSet[NodeFieldName] = frozenset(
+            field_name
+            for field_name, field_type in self.fields.items()
+            if field_type.multiple
+        )
+        # Optional fields default to None, or to [] if they are multiple.
+        self._defaults_none_keys: Tuple[NodeFieldName, ...] = tuple(
+            field_name
+            for field_name, field_type in self.fields.items()
+            if not field_type.required and not field_type.multiple
+        )
+        self._defaults_list_keys: Tuple[NodeFieldName, ...] = tuple(
+            field_name
+            for field_name, field_type in self.fields.items()
+            if not field_type.required and field_type.multiple
+        )
 
     @property
     def is_abstract(self) -> bool:
@@ -211,7 +333,9 @@ class NodeType(SimpleNodeType):
         if self.named:
             cls_name = as_class_name(self.type_name)
             if self.is_abstract:
-                # TODO: should be a dynamic type alias
+                # NOTE: This is a class rather than a Union of its subtypes,
+                #       because the classes of its subtypes inherit from it,
+                #       which lets isinstance check for abstract node types.
                 return type(cls_name, (Node,), {})
             else:
                 fields: Dict[NodeFieldName, Type[Any]] = {}
@@ -251,6 +375,10 @@ class NodeType(SimpleNodeType):
                     node_type.assert_equivalent(self, other)
 
                 # Create and return dataclass
+                # NOTE: make_dataclass already compiles a specialised __init__
+                #       for every class, which assigns each field directly and,
+                #       since none of the fields have defaults, does no further
+                #       processing of its arguments.
                 return make_dataclass(
                     cls_name=cls_name,
                     fields=fields.items(),
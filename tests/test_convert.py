@@ -1,12 +1,19 @@
+import gc
+import json
+import os
+import subprocess
 import sys
+import weakref
 from pathlib import Path
-from typing import List
+from typing import Any, Dict, List, Optional, Tuple, cast
 
 import pytest
 import tree_sitter
+from dataclasses_json import DataClassJsonMixin
 from pytest_golden.plugin import GoldenTestFixture
 
 import tree_sitter_type_provider
+from tree_sitter_type_provider import _child_nodes
 
 from . import node_dict_simplify
 
@@ -48,6 +55,7 @@ def test_talon(golden: GoldenTestFixture) -> None:
         node_types,
         as_class_name=as_class_name,
         extra=golden["input"]["extra"],
+        json=True,
     )
 
     contents = golden["input"]["contents"]
@@ -57,8 +65,341 @@ def test_talon(golden: GoldenTestFixture) -> None:
             tree.root_node, raise_parse_error=raise_parse_error
         )
         assert node.is_equivalent(node)
+        assert isinstance(node, DataClassJsonMixin)
         node_dict = node.to_dict()
+        assert node_dict == tree_sitter_type_provider.to_dict(node)
+        assert json.loads(tree_sitter_type_provider.to_json(node)) == node_dict
         node_dict_simplify(node_dict)
         assert node_dict == golden.out["output"]
     except tree_sitter_type_provider.ParseError as e:
         assert str(e) == golden.out["output"]
+
+
+TALON_LIBRARY_NAME = {
+    "linux": "tree_sitter_talon.so",
+    "darwin": "tree_sitter_talon.dylib",
+    "win32": "tree_sitter_talon.dll",
+}[sys.platform]
+
+
+def talon_node_types() -> List[Dict[str, Any]]:
+    node_types_json = TESTDIR / "data" / "node-types" / "talon.json"
+    return cast(List[Dict[str, Any]], json.loads(node_types_json.read_text()))
+
+
+def talon(
+    node_types_dicts: Optional[List[Dict[str, Any]]] = None,
+    **kwargs: Any,
+) -> Tuple[tree_sitter.Parser, tree_sitter_type_provider.TreeSitterTypeProvider]:
+    if node_types_dicts is None:
+        node_types_dicts = talon_node_types()
+    node_types = tree_sitter_type_provider.NodeType.schema().load(
+        node_types_dicts, many=True
+    )
+
+    repository_path = str(TESTDIR / "data" / "tree-sitter-talon")
+    library_path = str(TESTDIR / TALON_LIBRARY_NAME)
+    tree_sitter.Language.build_library(library_path, [repository_path])
+
+    language = tree_sitter.Language(library_path, "talon")
+    parser = tree_sitter.Parser()
+    parser.set_language(language)
+
+    types = tree_sitter_type_provider.TreeSitterTypeProvider(
+        "tree_sitter_talon", node_types, extra=["comment"], **kwargs
+    )
+    return (parser, types)
+
+
+def test_talon_deep() -> None:
+    parser, types = talon()
+
+    # NOTE: Trees are converted without recursion, so deeply nested trees do
+    #       not exceed the recursion limit.
+    contents = "x: " + "(" * 3000 + "1" + ")" * 3000
+    tree = parser.parse(bytes(contents, encoding="utf-8"))
+    node = types.from_tree_sitter(tree.root_node)
+    max_depth = 0
+    stack = [(node, 0)]
+    while stack:
+        descendant, depth = stack.pop()
+        max_depth = max(max_depth, depth)
+        stack.extend((child, depth + 1) for child in _child_nodes(descendant))
+    assert max_depth > 3000
+
+    # NOTE: Deeply nested trees can be converted to dictionaries.
+    max_dict_depth = 0
+    dict_stack = [(tree_sitter_type_provider.to_dict(node), 0)]
+    while dict_stack:
+        value, depth = dict_stack.pop()
+        max_dict_depth = max(max_dict_depth, depth)
+        if isinstance(value, dict):
+            dict_stack.extend((item, depth + 1) for item in value.values())
+        elif isinstance(value, list):
+            dict_stack.extend((item, depth) for item in value)
+    assert max_dict_depth > 3000
+
+    # NOTE: Deeply nested errors are raised as parse errors.
+    contents = "x: " + "(" * 3000 + "foo(1 ] 2" + ")" * 3000
+    tree = parser.parse(bytes(contents, encoding="utf-8"))
+    with pytest.raises(tree_sitter_type_provider.ParseError) as excinfo:
+        types.from_tree_sitter(tree.root_node, raise_parse_error=True)
+    assert excinfo.value.contents == contents
+
+
+def test_talon_unknown_node_type() -> None:
+    node_types_dicts = [
+        node_type_dict
+        for node_type_dict in talon_node_types()
+        if node_type_dict["type"] != "integer"
+    ]
+    parser, types = talon(node_types_dicts)
+
+    tree = parser.parse(b"foo: bar(1)\n")
+    with pytest.raises(tree_sitter_type_provider.NodeTypeError):
+        types.from_tree_sitter(tree.root_node)
+
+
+def test_talon_fields() -> None:
+    node_types_dicts = talon_node_types()
+    for node_type_dict in node_types_dicts:
+        if node_type_dict["type"] == "action":
+            node_type_dict["fields"]["arguments"]["multiple"] = True
+            node_type_dict["fields"]["optional"] = {
+                "multiple": False,
+                "required": False,
+                "types": [{"type": "identifier", "named": True}],
+            }
+            node_type_dict["fields"]["optionals"] = {
+                "multiple": True,
+                "required": False,
+                "types": [{"type": "identifier", "named": True}],
+            }
+    parser, types = talon(node_types_dicts)
+
+    tree = parser.parse(b"foo: bar(1)\n")
+    node = types.from_tree_sitter(tree.root_node)
+    actions = [
+        child for child in _child_nodes_deep(node) if child.type_name == "action"
+    ]
+    assert len(actions) == 1
+    (action,) = actions
+
+    # NOTE: Multiple fields are lists, and missing optional fields default to
+    #       None, or to [] if they are multiple.
+    arguments = getattr(action, "arguments")
+    assert isinstance(arguments, list)
+    assert [argument.type_name for argument in arguments] == ["argument_list"]
+    assert getattr(action, "optional") is None
+    assert getattr(action, "optionals") == []
+
+
+def test_talon_cursor() -> None:
+    parser, types = talon()
+
+    contents = "os: mac\n-\nfoo: bar(1)\n"
+    tree = parser.parse(bytes(contents, encoding="utf-8"))
+    root = types.from_tree_sitter(tree)
+    assert root == types.from_tree_sitter(tree.root_node)
+
+    # NOTE: Subtrees can be converted from a node or from a cursor, which is
+    #       left on the node where the walk started.
+    cursor = tree.walk()
+    assert cursor.goto_first_child()
+    tsnode = cursor.node
+    assert tsnode.is_named
+    node = types.from_tree_sitter(cursor)
+    assert cursor.node == tsnode
+    assert node == types.from_tree_sitter(tsnode)
+    assert node in list(_child_nodes(root))
+    assert node.text == tsnode.text.decode("utf-8")
+
+
+def test_talon_optimized() -> None:
+    # NOTE: Build the library used by the subprocess.
+    parser, types = talon()
+
+    # NOTE: The walk does not depend on asserts, which are stripped with -O.
+    contents = "os: mac\n-\nfoo: bar(1)\nbaz: qux(2)\n"
+    script = "\n".join(
+        [
+            "import sys, tree_sitter, tree_sitter_type_provider as tstp",
+            "library_path, node_types_json, contents = sys.argv[1:]",
+            "parser = tree_sitter.Parser()",
+            "parser.set_language(tree_sitter.Language(library_path, 'talon'))",
+            "node_types = tstp.NodeType.schema().loads(",
+            "    open(node_types_json).read(), many=True",
+            ")",
+            "types = tstp.TreeSitterTypeProvider(",
+            "    'tree_sitter_talon', node_types, extra=['comment']",
+            ")",
+            "node = types.from_tree_sitter(parser.parse(contents.encode()))",
+            "print(tstp.to_json(node))",
+        ]
+    )
+    result = subprocess.run(
+        [
+            sys.executable,
+            "-O",
+            "-W",
+            "ignore",
+            "-c",
+            script,
+            str(TESTDIR / TALON_LIBRARY_NAME),
+            str(TESTDIR / "data" / "node-types" / "talon.json"),
+            contents,
+        ],
+        check=True,
+        capture_output=True,
+        env={**os.environ, "PYTHONPATH": os.pathsep.join(sys.path)},
+        text=True,
+    )
+    tree = parser.parse(bytes(contents, encoding="utf-8"))
+    node = types.from_tree_sitter(tree)
+    assert json.loads(result.stdout) == tree_sitter_type_provider.to_dict(node)
+
+
+def _child_nodes_deep(
+    node: tree_sitter_type_provider.Node,
+) -> List[tree_sitter_type_provider.Node]:
+    nodes = [node]
+    for child in _child_nodes(node):
+        nodes.extend(_child_nodes_deep(child))
+    return nodes
+
+
+def test_talon_text() -> None:
+    parser, types = talon()
+
+    # NOTE: The text of large branches is decoded lazily.
+    contents = "os: mac\n-\n" + 'spoken command: user.spoken_command("é")\n' * 100
+    tree = parser.parse(bytes(contents, encoding="utf-8"))
+    node = types.from_tree_sitter(tree.root_node)
+    assert node.text == contents
+    assert node == types.from_tree_sitter(tree.root_node)
+
+
+@pytest.mark.skipif(
+    sys.version_info < (3, 10), reason="slots requires Python 3.10 or later"
+)
+def test_talon_text_slots() -> None:
+    parser, types = talon(dataclass_kwargs={"slots": True})
+
+    # NOTE: The text of nodes with slots cannot be decoded lazily.
+    contents = "os: mac\n-\n" + 'spoken command: user.spoken_command("é")\n' * 100
+    tree = parser.parse(bytes(contents, encoding="utf-8"))
+    node = types.from_tree_sitter(tree.root_node)
+    assert node.text == contents
+
+
+def test_talon_parent_of() -> None:
+    parser, types = talon()
+
+    contents = "os: mac\n-\n" + 'spoken command: user.spoken_command("é", 1)\n' * 50
+    tree = parser.parse(bytes(contents, encoding="utf-8"))
+    root = types.from_tree_sitter(tree.root_node)
+    assert types.parent_of(root, root=root) is None
+
+    def check(parent: tree_sitter_type_provider.Node) -> None:
+        for child in _child_nodes(parent):
+            assert types.parent_of(child, root=root) is parent
+            check(child)
+
+    # NOTE: Check twice, once without and once with cached parents.
+    check(root)
+    check(root)
+
+
+def test_talon_parent_of_cache() -> None:
+    parser, types = talon()
+
+    def check() -> "weakref.ref[tree_sitter_type_provider.Node]":
+        contents = "os: mac\n-\n" + 'spoken command: user.spoken_command("é")\n' * 5
+        tree = parser.parse(bytes(contents, encoding="utf-8"))
+        root = types.from_tree_sitter(tree.root_node)
+        child = next(_child_nodes(root))
+        grandchild = next(_child_nodes(child))
+        assert types.parent_of(grandchild, root=root) is child
+
+        # NOTE: Cached parents are only returned for the same root.
+        assert types.parent_of(grandchild, root=grandchild) is None
+        assert types.parent_of(grandchild, root=child) is child
+        return weakref.ref(root)
+
+    # NOTE: Cached parents do not keep the tree alive.
+    root_ref = check()
+    gc.collect()
+    assert root_ref() is None
+
+
+def test_talon_json() -> None:
+    # NOTE: The mixin is only added once, even if it is passed explicitly.
+    parser, types = talon(json=True, mixins=(DataClassJsonMixin,))
+
+    contents = "foo: bar(\n"
+    tree = parser.parse(bytes(contents, encoding="utf-8"))
+    node = types.from_tree_sitter(tree.root_node)
+    errors = [
+        child
+        for child in _child_nodes(node)
+        if isinstance(child, tree_sitter_type_provider.ParseError)
+    ]
+    assert errors
+    for error in errors:
+        assert isinstance(error, DataClassJsonMixin)
+        assert error.to_dict() == tree_sitter_type_provider.to_dict(error)
+        assert json.loads(error.to_json()) == tree_sitter_type_provider.to_dict(error)
+
+    with pytest.raises(tree_sitter_type_provider.ParseError) as excinfo:
+        types.from_tree_sitter(tree.root_node, raise_parse_error=True)
+    assert isinstance(excinfo.value, DataClassJsonMixin)
+
+
+@pytest.mark.parametrize("separator", ["\u2028", "\r", "\x0b", "\x0c"])
+def test_parse_error_lines(separator: str) -> None:
+    # NOTE: Lines are only separated by newlines, like tree-sitter rows.
+    line = f"foo{separator}bar"
+    error = tree_sitter_type_provider.ParseError(
+        text=line,
+        type_name="ERROR",
+        start_position=tree_sitter_type_provider.Point(1, 0),
+        end_position=tree_sitter_type_provider.Point(1, 2),
+        children=[],
+        contents=f"first\r\n{line}\r\nlast\n",
+    )
+    assert str(error) == (
+        "Parse error on line 1 between column 0 and 2:\n"
+        f"{line}\n"
+        f"^^^{' ' * (len(line) - 3)}\n"
+    )
+
+
+@pytest.mark.parametrize("gc_enabled", [True, False])
+@pytest.mark.parametrize("disable_gc", [True, False])
+@pytest.mark.parametrize("contents", ["foo: bar(1)\n", "foo: bar(\n"])
+def test_talon_disable_gc(gc_enabled: bool, disable_gc: bool, contents: str) -> None:
+    parser, types = talon()
+    tree = parser.parse(bytes(contents, encoding="utf-8"))
+
+    # NOTE: The garbage collector is restored after the conversion, whether
+    #       it returns or raises a parse error.
+    gc_was_enabled = gc.isenabled()
+    if gc_enabled:
+        gc.enable()
+    else:
+        gc.disable()
+    try:
+        types.from_tree_sitter(
+            tree.root_node, raise_parse_error=True, disable_gc=disable_gc
+        )
+    except tree_sitter_type_provider.ParseError:
+        assert tree.root_node.has_error
+    else:
+        assert not tree.root_node.has_error
+    finally:
+        gc_is_enabled = gc.isenabled()
+        if gc_was_enabled:
+            gc.enable()
+        else:
+            gc.disable()
+    assert gc_is_enabled == gc_enabled